@@ -2,7 +2,7 @@
 # 完整版：支援多輪對話 + OpenAI 兼容的 Grok API
 # ================================
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
@@ -15,6 +15,10 @@ import tiktoken
 import time
 import asyncio
 import os
+import hashlib
+import hmac
+import sqlite3
+import threading
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -81,6 +85,321 @@ class TokenCounter:
 
 token_counter = TokenCounter()
 
+# ================================
+# 用量帳本與配額
+# ================================
+
+def read_env_number(name: str, default, cast=int):
+    """讀取數值型環境變數，格式錯誤時記錄警告並使用預設值"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    try:
+        return cast(value)
+    except ValueError:
+        logger.warning(f"環境變數 {name}={value!r} 格式錯誤，使用預設值 {default}")
+        return default
+
+def read_env_json(name: str, default):
+    """讀取 JSON 格式的環境變數，格式錯誤時記錄警告並使用預設值"""
+    value = os.getenv(name)
+    if not value:
+        return default
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError as e:
+        logger.warning(f"環境變數 {name} 不是合法 JSON，使用預設值: {e}")
+        return default
+
+# 用量資料庫與批次寫入設定
+USAGE_DB_PATH = os.getenv("USAGE_DB_PATH", "usage.db")
+USAGE_FLUSH_INTERVAL = read_env_number("USAGE_FLUSH_INTERVAL", 5.0, float)
+USAGE_BATCH_SIZE = read_env_number("USAGE_BATCH_SIZE", 100)
+
+# 配額只套用在已登記的 Key 上：USAGE_ALLOWED_KEYS（逗號分隔）與 USAGE_KEY_QUOTAS 中的 Key。
+# 啟用配額後，未登記的 Key（包含沒有任何識別的 "anonymous"）會被拒絕，
+# 避免換一個隨機 Key 就拿到新的額度。
+# 每個已登記 Key 在配額週期內可用的 Token 數（0 表示不限制）
+USAGE_QUOTA_TOKENS = read_env_number("USAGE_QUOTA_TOKENS", 0)
+USAGE_QUOTA_WINDOW = read_env_number("USAGE_QUOTA_WINDOW", 86400)
+USAGE_ALLOWED_KEYS = [k.strip() for k in os.getenv("USAGE_ALLOWED_KEYS", "").split(",") if k.strip()]
+# 個別 Key 的配額覆寫，JSON 格式：{"<api key>": 100000}
+USAGE_KEY_QUOTAS = read_env_json("USAGE_KEY_QUOTAS", {})
+# 查詢其他 Key 用量所需的管理 Key（未設定時一律拒絕跨 Key 查詢）
+USAGE_ADMIN_KEY = os.getenv("USAGE_ADMIN_KEY")
+
+USAGE_BUCKETS = {
+    "minute": 60,
+    "hour": 3600,
+    "day": 86400
+}
+
+class QuotaExceededError(Exception):
+    """API Key 超出 Token 配額"""
+    pass
+
+class UnknownKeyError(Exception):
+    """啟用配額時，API Key 未登記"""
+    pass
+
+def hash_key(value: str) -> str:
+    """將 API Key / Cookie 轉為不可逆的識別碼，避免明文落地"""
+    return hashlib.sha256(value.encode("utf-8")).hexdigest()[:16]
+
+class UsageLedger:
+    """用量帳本：記憶體計數執行配額，背景任務批次寫入 SQLite"""
+
+    def __init__(self, db_path: str, quota_tokens: int = 0, quota_window: int = 86400,
+                 key_quotas: Optional[Dict[str, int]] = None, allowed_keys: Optional[List[str]] = None,
+                 flush_interval: float = 5.0, batch_size: int = 100):
+        if quota_window <= 0:
+            logger.warning(f"配額週期必須大於 0（收到 {quota_window}），使用預設值 86400")
+            quota_window = 86400
+        if not isinstance(key_quotas, dict):
+            if key_quotas is not None:
+                logger.warning("個別 Key 配額必須是 JSON 物件，已忽略")
+            key_quotas = {}
+
+        self.db_path = db_path
+        self.quota_tokens = quota_tokens
+        self.quota_window = quota_window
+        self.flush_interval = flush_interval
+        self.batch_size = max(1, batch_size)
+        self.key_quotas: Dict[str, int] = {}
+        for key, limit in key_quotas.items():
+            try:
+                self.key_quotas[hash_key(key)] = int(limit)
+            except (TypeError, ValueError):
+                logger.warning(f"個別 Key 配額數值錯誤（{limit!r}），已忽略")
+        self.known_keys = {hash_key(k) for k in (allowed_keys or [])} | set(self.key_quotas)
+        self.enforced = quota_tokens > 0 or bool(self.key_quotas)
+        if self.enforced and not self.known_keys:
+            logger.warning("已啟用 Token 配額但沒有登記任何 Key，所有請求都會被拒絕")
+
+        self.counters: Dict[str, int] = {}
+        self.window_start = self._current_window()
+        self.queue: Optional[asyncio.Queue] = None
+        self.task: Optional[asyncio.Task] = None
+        self.pending: set = set()
+        self.conn: Optional[sqlite3.Connection] = None
+        self.db_lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self.conn is not None
+
+    def _current_window(self) -> int:
+        now = int(time.time())
+        return now - now % self.quota_window
+
+    def _roll_window(self):
+        """進入新的配額週期時清空計數"""
+        window_start = self._current_window()
+        if window_start != self.window_start:
+            self.window_start = window_start
+            self.counters.clear()
+
+    def _open(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS usage (
+                ts REAL NOT NULL,
+                key_id TEXT NOT NULL,
+                account TEXT NOT NULL,
+                model TEXT NOT NULL,
+                model_mode TEXT NOT NULL,
+                prompt_tokens INTEGER NOT NULL,
+                completion_tokens INTEGER NOT NULL,
+                latency_ms INTEGER NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_usage_key_ts ON usage (key_id, ts)")
+        conn.commit()
+
+        # 從資料庫回填本週期的計數，重啟後配額不會歸零
+        self._roll_window()
+        rows = conn.execute(
+            "SELECT key_id, SUM(prompt_tokens + completion_tokens) FROM usage WHERE ts >= ? GROUP BY key_id",
+            (self.window_start,)
+        ).fetchall()
+        self.counters = {key_id: int(total) for key_id, total in rows}
+        self.conn = conn
+
+    def _write_batch(self, batch: List[tuple]):
+        with self.db_lock:
+            if self.conn is None:
+                raise RuntimeError("usage ledger is closed")
+            self.conn.executemany("INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?)", batch)
+            self.conn.commit()
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        await asyncio.get_running_loop().run_in_executor(None, self._open)
+        self.task = asyncio.create_task(self._run())
+        logger.info(f"用量帳本已啟動: {self.db_path}")
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        # 等待執行緒中尚未完成的寫入，再寫入剩餘紀錄，最後才關閉連線
+        if self.pending:
+            await asyncio.gather(*self.pending, return_exceptions=True)
+        await self.flush()
+        with self.db_lock:
+            if self.conn:
+                self.conn.close()
+                self.conn = None
+        self.queue = None
+
+    async def _run(self):
+        """背景任務：累積到批次大小或間隔時間到就寫入"""
+        while True:
+            batch = [await self.queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            try:
+                while len(batch) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    try:
+                        batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                    except asyncio.TimeoutError:
+                        break
+            except asyncio.CancelledError:
+                # 關閉時把已取出的紀錄寫完再結束
+                await self._commit(batch)
+                raise
+            await self._commit(batch)
+
+    async def _commit(self, batch: List[tuple]):
+        future = asyncio.get_running_loop().run_in_executor(None, self._write_batch, batch)
+        self.pending.add(future)
+        future.add_done_callback(self.pending.discard)
+        try:
+            # shield：背景任務被取消時寫入仍會完成，由 stop() 等待
+            await asyncio.shield(future)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"用量寫入失敗（{len(batch)} 筆）: {e}")
+
+    async def flush(self):
+        """立即寫入佇列中尚未落地的紀錄"""
+        if self.queue is None:
+            return
+        batch = []
+        while not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        if batch:
+            await self._commit(batch)
+
+    def quota_for(self, key_id: str) -> Optional[int]:
+        """取得 Key 的配額上限；未登記的 Key 回傳 None"""
+        if key_id in self.key_quotas:
+            return self.key_quotas[key_id]
+        if key_id in self.known_keys:
+            return self.quota_tokens
+        return None
+
+    def usage_for(self, key_id: str) -> int:
+        """取得 Key 在目前配額週期內已使用的 Token 數"""
+        self._roll_window()
+        return self.counters.get(key_id, 0)
+
+    def check_quota(self, key_id: str, tokens: int = 0):
+        """以記憶體計數檢查配額，超出時拋出 QuotaExceededError，未登記時拋出 UnknownKeyError"""
+        if not self.enforced:
+            return
+        limit = self.quota_for(key_id)
+        if limit is None:
+            raise UnknownKeyError("API key is not registered for token quota")
+        if limit <= 0:
+            return
+        used = self.usage_for(key_id)
+        if used + tokens > limit:
+            raise QuotaExceededError(f"Token quota exceeded: {used}/{limit} tokens used in current window")
+
+    def record(self, key_id: str, account: str, model: str, model_mode: str,
+               prompt_tokens: int, completion_tokens: int, latency_ms: int):
+        """記錄一次請求的用量（僅入佇列，不阻塞請求）"""
+        self._roll_window()
+        self.counters[key_id] = self.counters.get(key_id, 0) + prompt_tokens + completion_tokens
+        if self.queue is not None:
+            self.queue.put_nowait((time.time(), key_id, account, model, model_mode,
+                                   prompt_tokens, completion_tokens, latency_ms))
+
+    def _query(self, start: float, end: float, bucket: int, key_id: Optional[str]) -> List[Dict[str, Any]]:
+        sql = """
+            SELECT CAST(ts / ? AS INTEGER) * ? AS bucket_start, key_id, model, model_mode,
+                   COUNT(*), SUM(prompt_tokens), SUM(completion_tokens), AVG(latency_ms)
+            FROM usage WHERE ts >= ? AND ts < ?
+        """
+        params: List[Any] = [bucket, bucket, start, end]
+        if key_id:
+            sql += " AND key_id = ?"
+            params.append(key_id)
+        sql += " GROUP BY bucket_start, key_id, model, model_mode ORDER BY bucket_start"
+        with self.db_lock:
+            if self.conn is None:
+                raise RuntimeError("usage ledger is not open")
+            rows = self.conn.execute(sql, params).fetchall()
+        return [
+            {
+                "bucket_start": bucket_start,
+                "key_id": row_key,
+                "model": model,
+                "model_mode": model_mode,
+                "requests": count,
+                "prompt_tokens": prompt,
+                "completion_tokens": completion,
+                "total_tokens": prompt + completion,
+                "avg_latency_ms": round(latency, 1)
+            }
+            for bucket_start, row_key, model, model_mode, count, prompt, completion, latency in rows
+        ]
+
+    async def query(self, start: float, end: float, bucket: int, key_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        if not self.is_open:
+            raise RuntimeError("usage ledger is not open")
+        await self.flush()
+        return await asyncio.get_running_loop().run_in_executor(None, self._query, start, end, bucket, key_id)
+
+usage_ledger = UsageLedger(
+    USAGE_DB_PATH,
+    quota_tokens=USAGE_QUOTA_TOKENS,
+    quota_window=USAGE_QUOTA_WINDOW,
+    key_quotas=USAGE_KEY_QUOTAS,
+    allowed_keys=USAGE_ALLOWED_KEYS,
+    flush_interval=USAGE_FLUSH_INTERVAL,
+    batch_size=USAGE_BATCH_SIZE
+)
+
+def get_caller_key(http_request: Request, cookie: Optional[str] = None) -> str:
+    """取得呼叫者的 API Key：Authorization / X-API-Key 標頭，否則以 Cookie（請求內容或 X-Cookie 標頭）識別"""
+    auth = http_request.headers.get("authorization", "")
+    if auth.lower().startswith("bearer "):
+        return auth[7:].strip()
+    return (
+        http_request.headers.get("x-api-key")
+        or cookie
+        or http_request.headers.get("x-cookie")
+        or "anonymous"
+    )
+
+@app.on_event("startup")
+async def start_usage_ledger():
+    await usage_ledger.start()
+
+@app.on_event("shutdown")
+async def stop_usage_ledger():
+    await usage_ledger.stop()
+
 # ================================
 # 原生 API 資料模型
 # ================================
@@ -327,7 +646,8 @@ async def process_chat_request(
     model_mode: str = "MODEL_MODE_AUTO",
     cookie: Optional[str] = None,
     conversation_id: Optional[str] = None,
-    parent_response_id: Optional[str] = None
+    parent_response_id: Optional[str] = None,
+    caller_key: Optional[str] = None
 ) -> Dict[str, Any]:
     """處理聊天請求的核心函數"""
     
@@ -341,6 +661,11 @@ async def process_chat_request(
     # 計算輸入 Token
     input_tokens = token_counter.count_tokens(message)
     
+    # 檢查呼叫者配額
+    key_id = hash_key(caller_key or cookie or "anonymous")
+    usage_ledger.check_quota(key_id, input_tokens)
+    started_at = time.monotonic()
+    
     # 判斷是新對話還是繼續對話
     is_new_conversation = False
     
@@ -390,6 +715,17 @@ async def process_chat_request(
         output_tokens = token_counter.count_tokens(response_text)
         total_tokens = input_tokens + output_tokens
         
+        # 記錄用量（背景批次寫入）
+        usage_ledger.record(
+            key_id=key_id,
+            account=hash_key(headers["Cookie"]),
+            model=model,
+            model_mode=model_mode,
+            prompt_tokens=input_tokens,
+            completion_tokens=output_tokens,
+            latency_ms=int((time.monotonic() - started_at) * 1000)
+        )
+        
         return {
             "response": response_text,
             "conversation_id": conversation_id,
@@ -421,7 +757,8 @@ async def root():
             "native": {
                 "chat": "/api/chat",
                 "count_tokens": "/api/count-tokens",
-                "model_modes": "/api/model-modes"
+                "model_modes": "/api/model-modes",
+                "usage": "/api/usage"
             },
             "openai_compatible": {
                 "chat": "/v1/chat/completions",
@@ -434,7 +771,8 @@ async def root():
             "支援多輪對話",
             "支援自定義 Cookie",
             "支援 Token 計算",
-            "支援設定 modelMode"
+            "支援設定 modelMode",
+            "支援用量記錄與 Token 配額"
         ]
     }
 
@@ -443,7 +781,7 @@ async def health():
     return {"status": "healthy"}
 
 @app.post("/api/chat", response_model=ChatResponse)
-async def chat(request: ChatRequest):
+async def chat(request: ChatRequest, http_request: Request):
     """原生 API 聊天端點"""
     try:
         if not request.message:
@@ -455,7 +793,8 @@ async def chat(request: ChatRequest):
             model_mode=request.model_mode,
             cookie=request.cookie,
             conversation_id=request.conversation_id,
-            parent_response_id=request.parent_response_id
+            parent_response_id=request.parent_response_id,
+            caller_key=get_caller_key(http_request, request.cookie)
         )
         
         return ChatResponse(
@@ -463,6 +802,9 @@ async def chat(request: ChatRequest):
             data=result
         )
         
+    except (QuotaExceededError, UnknownKeyError) as e:
+        logger.warning(f"配額檢查未通過: {str(e)}")
+        return ChatResponse(success=False, error=str(e))
     except requests.Timeout:
         logger.error("請求逾時")
         return ChatResponse(success=False, error="Request timeout")
@@ -495,12 +837,62 @@ async def get_model_modes():
         }
     }
 
+@app.get("/api/usage")
+async def get_usage(
+    http_request: Request,
+    bucket: str = "hour",
+    start: Optional[float] = None,
+    end: Optional[float] = None,
+    key_id: Optional[str] = None,
+    all_keys: bool = False
+):
+    """
+    查詢用量統計（依時間區間彙總）
+    預設查詢呼叫者自己的 Key 最近 24 小時（以 Cookie 識別的呼叫者請帶 X-Cookie 標頭）
+    key_id / all_keys=true 需要 USAGE_ADMIN_KEY
+    """
+    if bucket not in USAGE_BUCKETS:
+        raise HTTPException(status_code=400, detail=f"bucket must be one of {list(USAGE_BUCKETS)}")
+    
+    caller_key = get_caller_key(http_request)
+    if all_keys or key_id:
+        if not USAGE_ADMIN_KEY or not hmac.compare_digest(caller_key.encode("utf-8"), USAGE_ADMIN_KEY.encode("utf-8")):
+            raise HTTPException(status_code=403, detail="Admin key required to query other keys")
+    
+    if not usage_ledger.is_open:
+        raise HTTPException(status_code=503, detail="Usage ledger is not available")
+    
+    end = end if end is not None else time.time()
+    start = start if start is not None else end - 86400
+    if not all_keys and not key_id:
+        key_id = hash_key(caller_key)
+    
+    buckets = await usage_ledger.query(start, end, USAGE_BUCKETS[bucket], None if all_keys else key_id)
+    
+    response = {
+        "bucket": bucket,
+        "start": start,
+        "end": end,
+        "data": buckets
+    }
+    if not all_keys:
+        response["key_id"] = key_id
+        response["quota"] = {
+            "enforced": usage_ledger.enforced,
+            "registered": usage_ledger.quota_for(key_id) is not None,
+            "limit": usage_ledger.quota_for(key_id),
+            "used": usage_ledger.usage_for(key_id),
+            "window_seconds": usage_ledger.quota_window,
+            "window_start": usage_ledger.window_start
+        }
+    return response
+
 # ================================
 # OpenAI 兼容 API 路由
 # ================================
 
 @app.post("/v1/chat/completions")
-async def openai_chat(request: OpenAIRequest):
+async def openai_chat(request: OpenAIRequest, http_request: Request):
     """
     OpenAI 兼容聊天端點
     可直接在 Dify 中作為模型供應商使用
@@ -533,7 +925,8 @@ async def openai_chat(request: OpenAIRequest):
             model_mode=metadata.get("model_mode", "MODEL_MODE_AUTO"),
             cookie=metadata.get("cookie"),
             conversation_id=metadata.get("conversation_id"),
-            parent_response_id=metadata.get("parent_response_id")
+            parent_response_id=metadata.get("parent_response_id"),
+            caller_key=get_caller_key(http_request, metadata.get("cookie"))
         )
         
         # 如果是串流模式
@@ -609,6 +1002,10 @@ async def openai_chat(request: OpenAIRequest):
         
     except HTTPException:
         raise
+    except QuotaExceededError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except UnknownKeyError as e:
+        raise HTTPException(status_code=403, detail=str(e))
     except Exception as e:
         logger.error(f"OpenAI endpoint error: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,155 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+
+import main
+from main import QuotaExceededError, UnknownKeyError, UsageLedger, hash_key
+
+
+def make_ledger(tmp_path, **kwargs):
+    kwargs.setdefault("flush_interval", 0.05)
+    return UsageLedger(str(tmp_path / "usage.db"), **kwargs)
+
+
+def record(ledger, key, prompt=10, completion=20, model_mode="MODEL_MODE_AUTO"):
+    ledger.record(hash_key(key), hash_key("cookie"), "grok-3", model_mode, prompt, completion, 100)
+
+
+def test_record_flush_query(tmp_path):
+    async def scenario():
+        ledger = make_ledger(tmp_path)
+        await ledger.start()
+        record(ledger, "alice")
+        record(ledger, "alice", model_mode="MODEL_MODE_FAST")
+        record(ledger, "bob")
+        rows = await ledger.query(0, 2 ** 40, 3600, hash_key("alice"))
+        await ledger.stop()
+        return rows
+
+    rows = asyncio.run(scenario())
+    assert {row["model_mode"] for row in rows} == {"MODEL_MODE_AUTO", "MODEL_MODE_FAST"}
+    assert sum(row["total_tokens"] for row in rows) == 60
+    assert all(row["key_id"] == hash_key("alice") for row in rows)
+
+
+def test_background_task_writes_batches(tmp_path):
+    async def scenario():
+        ledger = make_ledger(tmp_path, batch_size=2)
+        await ledger.start()
+        for _ in range(5):
+            record(ledger, "alice")
+        await asyncio.sleep(0.3)
+        assert ledger.queue.empty()
+        rows = ledger._query(0, 2 ** 40, 86400, None)
+        await ledger.stop()
+        return rows
+
+    rows = asyncio.run(scenario())
+    assert rows[0]["requests"] == 5
+
+
+def test_stop_writes_pending_records_and_restart_backfills(tmp_path):
+    async def scenario():
+        ledger = make_ledger(tmp_path, flush_interval=60)
+        await ledger.start()
+        record(ledger, "alice")
+        await asyncio.sleep(0)
+        record(ledger, "alice")
+        await ledger.stop()
+        assert not ledger.is_open
+
+        restarted = make_ledger(tmp_path)
+        await restarted.start()
+        used = restarted.usage_for(hash_key("alice"))
+        await restarted.stop()
+        return used
+
+    assert asyncio.run(scenario()) == 60
+
+
+def test_query_requires_open_ledger(tmp_path):
+    ledger = make_ledger(tmp_path)
+    with pytest.raises(RuntimeError):
+        asyncio.run(ledger.query(0, 1, 3600))
+
+
+def test_quota_only_for_registered_keys(tmp_path):
+    ledger = make_ledger(tmp_path, quota_tokens=50, allowed_keys=["alice"], key_quotas={"vip": 1000})
+    record(ledger, "alice")
+    ledger.check_quota(hash_key("alice"), 20)
+    with pytest.raises(QuotaExceededError):
+        ledger.check_quota(hash_key("alice"), 21)
+    ledger.check_quota(hash_key("vip"), 900)
+    for key in ("alice2", "anonymous"):
+        with pytest.raises(UnknownKeyError):
+            ledger.check_quota(hash_key(key))
+
+
+def test_quota_disabled_by_default(tmp_path):
+    ledger = make_ledger(tmp_path)
+    record(ledger, "anyone", prompt=10 ** 6)
+    ledger.check_quota(hash_key("anyone"), 10 ** 6)
+
+
+def test_quota_window_rollover(tmp_path):
+    ledger = make_ledger(tmp_path, quota_tokens=50, allowed_keys=["alice"])
+    record(ledger, "alice", prompt=20, completion=20)
+    assert ledger.usage_for(hash_key("alice")) == 40
+    ledger.window_start -= ledger.quota_window
+    assert ledger.usage_for(hash_key("alice")) == 0
+    ledger.check_quota(hash_key("alice"), 50)
+
+
+def test_invalid_config_falls_back(tmp_path):
+    ledger = make_ledger(tmp_path, quota_window=0, key_quotas=["not", "a", "dict"])
+    assert ledger.quota_window == 86400
+    assert ledger.key_quotas == {}
+    assert make_ledger(tmp_path, key_quotas={"a": "lots"}).key_quotas == {}
+
+
+def test_invalid_env_does_not_crash(monkeypatch):
+    monkeypatch.setenv("USAGE_KEY_QUOTAS", "{not json")
+    monkeypatch.setenv("USAGE_QUOTA_WINDOW", "daily")
+    assert main.read_env_json("USAGE_KEY_QUOTAS", {}) == {}
+    assert main.read_env_number("USAGE_QUOTA_WINDOW", 86400) == 86400
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "usage_ledger", make_ledger(tmp_path))
+    monkeypatch.setattr(main, "USAGE_ADMIN_KEY", None)
+    with TestClient(main.app) as test_client:
+        yield test_client
+
+
+def test_usage_endpoint_own_key(client):
+    record(main.usage_ledger, "alice")
+    response = client.get("/api/usage", headers={"Authorization": "Bearer alice"})
+    assert response.status_code == 200
+    body = response.json()
+    assert body["key_id"] == hash_key("alice")
+    assert body["quota"]["used"] == 30
+    assert body["data"][0]["total_tokens"] == 30
+
+
+def test_usage_endpoint_cookie_caller(client):
+    record(main.usage_ledger, "my-cookie")
+    response = client.get("/api/usage", headers={"X-Cookie": "my-cookie"})
+    assert response.json()["key_id"] == hash_key("my-cookie")
+    assert response.json()["quota"]["used"] == 30
+
+
+def test_usage_endpoint_cross_key_requires_admin(client, monkeypatch):
+    assert client.get("/api/usage?all_keys=true").status_code == 403
+    assert client.get(f"/api/usage?key_id={hash_key('alice')}").status_code == 403
+
+    monkeypatch.setattr(main, "USAGE_ADMIN_KEY", "admin")
+    assert client.get("/api/usage?all_keys=true", headers={"X-API-Key": "other"}).status_code == 403
+    assert client.get("/api/usage?all_keys=true", headers={"X-API-Key": "admin"}).status_code == 200
+
+
+def test_usage_endpoint_ledger_unavailable(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "usage_ledger", make_ledger(tmp_path))
+    client = TestClient(main.app)
+    assert client.get("/api/usage").status_code == 503